@@ -1,5 +1,6 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+from typing import List, Dict, Any
 import os
 from datetime import datetime
 from collections import Counter
@@ -17,6 +18,11 @@ app = FastAPI(
 class FindRequest(BaseModel):
     path: str
 
+class FindResponse(BaseModel):
+    search_path: str
+    files_found: int
+    files: List[Dict[str, Any]]
+
 class ProcessRequest(BaseModel):
     search_path: str
     output_dir: str
@@ -24,7 +30,8 @@ class ProcessRequest(BaseModel):
 
 # --- Endpoints ---
 
-@app.post("/find", summary="Find and list SUNAT files")
+# With a response model, FastAPI serializes the (possibly huge) file list straight to JSON through Pydantic
+@app.post("/find", response_model=FindResponse, summary="Find and list SUNAT files")
 def find_endpoint(request: FindRequest):
     """
     Searches for SUNAT-compliant filenames in the provided directory path.
@@ -79,23 +86,22 @@ def process_endpoint(request: ProcessRequest):
         if not all_found_files:
             return {"message": "No files found in scan.", "files_found": 0}
 
-        # Step 2: Prepare files for packaging and deletion
+        # Step 2: Prepare files for packaging and deletion, counting classifications in the same pass
         files_to_package = []
         physical_files_to_delete = set()
+        stats_packaged = Counter()
         for file_info in all_found_files:
             if file_info.get('status') == 'UNICO':
                 files_to_package.append(file_info)
-            
-            base_path = file_info['path'].split(':')[0]
-            physical_files_to_delete.add(base_path)
+                stats_packaged[file_info.get('classification', 'unknown')] += 1
+
+            physical_files_to_delete.add(file_info['base_path'])
 
         if not files_to_package:
             return {"message": "No unique files found to package.", "unique_files_packaged": 0}
 
-        # Step 3: Calculate statistics
+        # Step 3: Statistics were gathered in step 2
         total_unique_packaged = len(files_to_package)
-        classifications_packaged = [f.get('classification', 'unknown') for f in files_to_package]
-        stats_packaged = Counter(classifications_packaged)
 
         # Step 4: Generate filenames and paths
         log_dir = 'logs'
@@ -38,8 +38,7 @@ def run_find(args):
 
     # --- Statistics ---
     total_files = len(found_files)
-    classifications = [f.get('classification', 'unknown') for f in found_files]
-    stats = Counter(classifications)
+    stats = Counter(f.get('classification', 'unknown') for f in found_files)
 
     print("--- Resumen del Escaneo ---")
     print(f"Total de archivos encontrados: {total_files}")
@@ -59,7 +58,7 @@ def run_find(args):
     try:
         with open(log_filepath, 'w', newline='', encoding='utf-8') as csvfile:
             # Define headers - use a subset of all possible keys
-            headers = ["status", "classification", "filename", "path", "ext"]
+            headers = ["status", "classification", "filename", "path", "base_path", "ext"]
             writer = csv.DictWriter(csvfile, fieldnames=headers, extrasaction='ignore')
             
             writer.writeheader()
@@ -82,14 +81,17 @@ def run_process(args):
     # --- Read and prepare file lists ---
     files_to_package = []
     physical_files_to_delete = set()
+    stats = Counter()
     try:
         with open(args.input_csv, 'r', encoding='utf-8') as csvfile:
             reader = csv.DictReader(csvfile)
             for row in reader:
                 if row.get('status') == 'UNICO':
                     files_to_package.append(row)
+                    stats[row.get('classification', 'unknown')] += 1
                 
-                base_path = row['path'].split(':')[0]
+                # Logs written before the base_path column existed only have the full path
+                base_path = row.get('base_path') or row['path'].split(':')[0]
                 physical_files_to_delete.add(base_path)
 
     except (IOError, csv.Error) as e:
@@ -102,8 +104,6 @@ def run_process(args):
 
     # --- Statistics for Processing ---
     total_to_package = len(files_to_package)
-    classifications = [f.get('classification', 'unknown') for f in files_to_package]
-    stats = Counter(classifications)
 
     print("--- Resumen del Procesamiento ---")
     print(f"Total de archivos únicos a empaquetar: {total_to_package}")
@@ -1,113 +1,299 @@
+import functools
+import io
 import os
 import re
+import shutil
+import sys
+import tempfile
 import zipfile
-import io
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List, Dict, Any
 
-# Patrones regex para los nombres estructurados de archivos SUNAT
+# Hilos usados para inspeccionar en paralelo los ZIPs encontrados en disco
+MAX_ZIP_WORKERS = (os.cpu_count() or 1) * 2
+# Hilos usados para listar directorios por adelantado durante el recorrido
+MAX_SCAN_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# ZIPs anidados hasta este tamaño se inspeccionan en memoria; los más grandes pasan por un archivo temporal
+MAX_ZIP_ANIDADO_EN_MEMORIA = 64 << 20
+
+# Directorios que nunca contienen comprobantes y no se recorren (además de los ocultos, que empiezan con '.')
+DIRECTORIOS_IGNORADOS = frozenset({"__pycache__", "node_modules", ".git", ".venv", "venv"})
+
+# Patrones regex para los nombres estructurados de archivos SUNAT (se compilan juntos en PATRON_COMBINADO)
+# Los patrones están en minúsculas y se comparan contra el nombre en minúsculas (sin re.IGNORECASE)
 PATRONES_ESTRUCTURADOS = {
-    "guia_remision": (re.compile(r"^(\d{11})-09-([A-Z0-9]{4})-(\d{1,8})\.(pdf|xml)$", re.IGNORECASE), ["ruc", "serie", "correlativo", "ext"]),
-    "reporte_planilla_zip": (re.compile(r"^(\d{11})_[A-Z]+_(\d{8})\.(zip)$", re.IGNORECASE), ["ruc", "periodo", "ext"]),
-    "declaraciones_pagos": (re.compile(r"^DetalleDeclaraciones_(\d{11})_(\d{14})\.(xlsx)$", re.IGNORECASE), ["ruc", "timestamp", "ext"]),
-    "ficha_ruc": (re.compile(r"^reporteec_ficharuc_(\d{11})_(\d{14})\.(pdf)$", re.IGNORECASE), ["ruc", "timestamp", "ext"]),
-    "ingreso_recaudacion": (re.compile(r"^ridetrac_(\d{11})_(\d{13})_(\d{14})_(\d{9})\.(pdf)$", re.IGNORECASE), ["ruc", "num_operacion", "timestamp", "id", "ext"]),
-    "liberacion_fondos": (re.compile(r"^rilf_(\d{11})_(\d{13})_(\d{14})_(\d{9})\.(pdf)$", re.IGNORECASE), ["ruc", "num_operacion", "timestamp", "id", "ext"]),
-    "multa": (re.compile(r"^rmgen_(\d{11})_(\d{3})-(\d{3})-(\d{7})_(\d{14})_(\d{9})\.(pdf)$", re.IGNORECASE), ["ruc", "cod1", "cod2", "num_multa", "timestamp", "id", "ext"]),
-    "notificacion": (re.compile(r"^constancia_(\d{14})_(\d{20})_(\d{13})_(\d{9})\.(pdf)$", re.IGNORECASE), ["timestamp", "id_notif", "num_operacion", "id", "ext"]),
-    "valores": (re.compile(r"^rvalores_(\d{11})_([A-Z0-9]{12,17})_(\d{14})_(\d{9})\.(pdf)$", re.IGNORECASE), ["ruc", "num_valor", "timestamp", "id", "ext"]),
-    "coactiva": (re.compile(r"^recgen_(\d{11})_(\d{13})_(\d{14})_(\d{9})\.(pdf)$", re.IGNORECASE), ["ruc", "num_expediente", "timestamp", "id", "ext"]),
-    "baja_oficio": (re.compile(r"^bod_(\d{6})_(\d{11})_(\d{4})\.(pdf)$", re.IGNORECASE), ["id_baja", "ruc", "periodo", "ext"]),
-    "factura": (re.compile(r"^(?:\d{11}-)?(01)-([A-Z0-9]{4})-(\d{1,8})\.(xml|zip|pdf)$", re.IGNORECASE), ["tipo_doc", "serie", "correlativo", "ext"]),
-    "boleta": (re.compile(r"^(?:\d{11}-)?(03)-([A-Z0-9]{4})-(\d{1,8})\.(xml|zip|pdf)$", re.IGNORECASE), ["tipo_doc", "serie", "correlativo", "ext"]),
-    "nota_credito": (re.compile(r"^(?:\d{11}-)?(07)-([A-Z0-9]{4})-(\d{1,8})\.(xml|zip|pdf)$", re.IGNORECASE), ["tipo_doc", "serie", "correlativo", "ext"]),
-    "nota_debito": (re.compile(r"^(?:\d{11}-)?(08)-([A-Z0-9]{4})-(\d{1,8})\.(xml|zip|pdf)$", re.IGNORECASE), ["tipo_doc", "serie", "correlativo", "ext"]),
-    "recibo_honorarios": (re.compile(r"^(?:\d{11}-)?(RHE)-([A-Z0-9]{4})-(\d{1,8})\.(xml|pdf)$", re.IGNORECASE), ["tipo_doc", "serie", "correlativo", "ext"]),
+    "guia_remision": (r"^(\d{11})-09-([a-z0-9]{4})-(\d{1,8})\.(pdf|xml)$", ["ruc", "serie", "correlativo", "ext"]),
+    "reporte_planilla_zip": (r"^(\d{11})_[a-z]+_(\d{8})\.(zip)$", ["ruc", "periodo", "ext"]),
+    "declaraciones_pagos": (r"^detalledeclaraciones_(\d{11})_(\d{14})\.(xlsx)$", ["ruc", "timestamp", "ext"]),
+    "ficha_ruc": (r"^reporteec_ficharuc_(\d{11})_(\d{14})\.(pdf)$", ["ruc", "timestamp", "ext"]),
+    "ingreso_recaudacion": (r"^ridetrac_(\d{11})_(\d{13})_(\d{14})_(\d{9})\.(pdf)$", ["ruc", "num_operacion", "timestamp", "id", "ext"]),
+    "liberacion_fondos": (r"^rilf_(\d{11})_(\d{13})_(\d{14})_(\d{9})\.(pdf)$", ["ruc", "num_operacion", "timestamp", "id", "ext"]),
+    "multa": (r"^rmgen_(\d{11})_(\d{3})-(\d{3})-(\d{7})_(\d{14})_(\d{9})\.(pdf)$", ["ruc", "cod1", "cod2", "num_multa", "timestamp", "id", "ext"]),
+    "notificacion": (r"^constancia_(\d{14})_(\d{20})_(\d{13})_(\d{9})\.(pdf)$", ["timestamp", "id_notif", "num_operacion", "id", "ext"]),
+    "valores": (r"^rvalores_(\d{11})_([a-z0-9]{12,17})_(\d{14})_(\d{9})\.(pdf)$", ["ruc", "num_valor", "timestamp", "id", "ext"]),
+    "coactiva": (r"^recgen_(\d{11})_(\d{13})_(\d{14})_(\d{9})\.(pdf)$", ["ruc", "num_expediente", "timestamp", "id", "ext"]),
+    "baja_oficio": (r"^bod_(\d{6})_(\d{11})_(\d{4})\.(pdf)$", ["id_baja", "ruc", "periodo", "ext"]),
+    "factura": (r"^(?:\d{11}-)?(01)-([a-z0-9]{4})-(\d{1,8})\.(xml|zip|pdf)$", ["tipo_doc", "serie", "correlativo", "ext"]),
+    "boleta": (r"^(?:\d{11}-)?(03)-([a-z0-9]{4})-(\d{1,8})\.(xml|zip|pdf)$", ["tipo_doc", "serie", "correlativo", "ext"]),
+    "nota_credito": (r"^(?:\d{11}-)?(07)-([a-z0-9]{4})-(\d{1,8})\.(xml|zip|pdf)$", ["tipo_doc", "serie", "correlativo", "ext"]),
+    "nota_debito": (r"^(?:\d{11}-)?(08)-([a-z0-9]{4})-(\d{1,8})\.(xml|zip|pdf)$", ["tipo_doc", "serie", "correlativo", "ext"]),
+    "recibo_honorarios": (r"^(?:\d{11}-)?(rhe)-([a-z0-9]{4})-(\d{1,8})\.(xml|pdf)$", ["tipo_doc", "serie", "correlativo", "ext"]),
 }
 
+# Filtro previo al regex: extensiones usadas en los patrones y el nombre más corto posible ("01-F001-1.xml")
+EXTENSIONES_VALIDAS = frozenset({"pdf", "xml", "zip", "xlsx"})
+LONGITUD_MINIMA_NOMBRE = 13
+
+# Campos con pocos valores distintos (se repiten en miles de archivos): se internan para compartir un solo string
+CAMPOS_REPETIDOS = frozenset({"ruc", "tipo_doc", "serie", "periodo", "ext"})
+
+def _name_groups(doc_type: str, pattern: str, fields: List[str]) -> str:
+    """Turns the positional captures of a pattern into named groups prefixed by its doc type."""
+    names = iter(fields)
+    return re.sub(r"\((?!\?)", lambda _: f"(?P<{doc_type}_{next(names)}>", pattern)
+
+# Todos los patrones fusionados en una sola alternancia: cada alternativa es un grupo
+# nombrado con su tipo de documento, así que un único match() clasifica el archivo.
+# El orden de PATRONES_ESTRUCTURADOS se mantiene como prioridad entre alternativas.
+PATRON_COMBINADO = re.compile(
+    "|".join(
+        f"(?P<{doc_type}>{_name_groups(doc_type, pattern, fields)})"
+        for doc_type, (pattern, fields) in PATRONES_ESTRUCTURADOS.items()
+    )
+)
+
+# Tipo de documento -> [(campo, nombre del grupo en PATRON_COMBINADO)]
+GRUPOS_POR_TIPO = {
+    doc_type: [(field, f"{doc_type}_{field}") for field in fields]
+    for doc_type, (_, fields) in PATRONES_ESTRUCTURADOS.items()
+}
+
+def _classify_name(filename: str):
+    """
+    Classifies a filename against the combined pattern of all known document types.
+
+    Returns a (doc_type, ((field, value), ...)) pair, or None when nothing matches.
+    """
+    # Cheap rejection of names that can't match any pattern, done before the cache
+    # so the bulk of unrelated files never take (or evict) a cache slot
+    if len(filename) < LONGITUD_MINIMA_NOMBRE:
+        return None
+    if filename.rpartition('.')[2].lower() not in EXTENSIONES_VALIDAS:
+        return None
+    # Patterns are ASCII-only; this also keeps lower() from changing the name's length
+    if not filename.isascii():
+        return None
+    return _match_name(filename)
+
+@functools.lru_cache(maxsize=65536)
+def _match_name(filename: str):
+    """Runs the combined pattern on a candidate name. Cached because the same names repeat across folders and monthly ZIP bundles."""
+    match = PATRON_COMBINADO.match(filename.lower())
+    if not match:
+        return None
+
+    # The outer group of the matching alternative is the last one to close
+    doc_type = match.lastgroup
+    fields = []
+    for field, group_name in GRUPOS_POR_TIPO[doc_type]:
+        # Take the value from the original name to keep its case (e.g. the serie)
+        start, end = match.span(group_name)
+        value = filename[start:end]
+        fields.append((field, sys.intern(value) if field in CAMPOS_REPETIDOS else value))
+    return doc_type, tuple(fields)
+
+def _make_record(classified: tuple, filename: str, path: str) -> Dict[str, Any]:
+    """Builds the file record for a name already classified by _classify_name."""
+    doc_type, fields = classified
+    file_info = {
+        "classification": doc_type,
+        "filename": filename,
+        "path": path,
+    }
+    # Assign the captured groups to their field names
+    file_info.update(fields)
+    return file_info
+
 def _analyze_filename(filename: str, path: str) -> Dict[str, Any]:
-    """Tries to match a filename against all known patterns."""
-    for doc_type, (pattern, fields) in PATRONES_ESTRUCTURADOS.items():
-        match = pattern.match(filename)
-        if match:
-            groups = match.groups()
-            file_info = {
-                "classification": doc_type,
-                "filename": filename,
-                "path": path,
-            }
-            # Dynamically assign captured groups to their field names
-            for i, field in enumerate(fields):
-                file_info[field] = groups[i]
-            return file_info
-    return None
-
-def _analyze_zip_recursively(zip_file: zipfile.ZipFile, current_path: str, found_files: List[Dict[str, Any]], seen_filenames: set):
-    """Recursively analyzes a zip file's contents."""
+    """Builds the file record for a filename found at path, or returns None if it isn't a SUNAT file."""
+    classified = _classify_name(filename)
+    if classified is None:
+        return None
+    return _make_record(classified, filename, path)
+
+def _analyze_zip_recursively(zip_file: zipfile.ZipFile, current_path: str, base_path: str, zip_parts: List[str], found_files: List[Dict[str, Any]]):
+    """
+    Recursively analyzes a zip file's contents.
+
+    base_path is the container file on disk and zip_parts the chain of nested
+    ZIP names leading to zip_file; both are stored on every file found.
+    """
     for zip_info in zip_file.infolist():
         if zip_info.is_dir():
             continue
 
-        filename = os.path.basename(zip_info.filename)
+        # Member names always use '/', so this is all os.path.basename would do
+        filename = zip_info.filename.rpartition('/')[2]
+        classified = _classify_name(filename)
+        # Members that are neither SUNAT files nor ZIPs to search need no paths built
+        if classified is None and not filename.lower().endswith(".zip"):
+            continue
+
         nested_path = f"{current_path}:{zip_info.filename}"
+        inner_paths = zip_parts + [zip_info.filename]
 
-        file_details = _analyze_filename(filename, nested_path)
+        file_details = _make_record(classified, filename, nested_path) if classified else None
         if file_details:
-            if filename in seen_filenames:
-                file_details['status'] = 'DUPLICADO'
-            else:
-                file_details['status'] = 'UNICO'
-                seen_filenames.add(filename)
+            file_details['base_path'] = base_path
+            file_details['inner_paths'] = inner_paths
+            file_details['size'] = zip_info.file_size
             found_files.append(file_details)
 
         # If a nested zip doesn't match a pattern, search inside it
         if filename.lower().endswith(".zip") and not file_details:
             try:
-                with zip_file.open(zip_info) as nested_file:
-                    nested_bytes = io.BytesIO(nested_file.read())
-                    with zipfile.ZipFile(nested_bytes) as nested_zip:
-                        _analyze_zip_recursively(nested_zip, nested_path, found_files, seen_filenames)
+                # ZipFile seeks back and forth; on a member stream each backward seek inflates
+                # again from the start, so copy it out once (to a temporary file when large)
+                if zip_info.file_size <= MAX_ZIP_ANIDADO_EN_MEMORIA:
+                    nested_file = io.BytesIO()
+                else:
+                    nested_file = tempfile.TemporaryFile()
+                with nested_file:
+                    with zip_file.open(zip_info) as member:
+                        shutil.copyfileobj(member, nested_file, 1 << 20)
+                    nested_file.seek(0)
+                    with zipfile.ZipFile(nested_file) as nested_zip:
+                        _analyze_zip_recursively(nested_zip, nested_path, base_path, inner_paths, found_files)
             except zipfile.BadZipFile:
                 print(f"⚠️ Invalid nested zip file: {nested_path}")
                 continue
 
+def _process_zip_file(full_path: str) -> List[Dict[str, Any]]:
+    """Analyzes a ZIP on disk and returns the SUNAT files found inside it. Runs in a worker thread."""
+    found_files = []
+    try:
+        with zipfile.ZipFile(full_path) as zip_file:
+            _analyze_zip_recursively(zip_file, full_path, full_path, [], found_files)
+    except zipfile.BadZipFile:
+        print(f"⚠️ Invalid zip file on disk: {full_path}")
+    return found_files
+
+def _list_directory(path: str):
+    """Lists a directory, returning its file DirEntries and the subdirectory paths worth walking."""
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                name = entry.name
+                # macOS '._*' resource forks are skipped before any type check; they
+                # would otherwise be opened as ZIPs when the original is one
+                if name.startswith('._'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if not name.startswith('.') and name not in DIRECTORIOS_IGNORADOS:
+                        subdirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry)
+    except OSError:
+        pass
+    return files, subdirs
+
+def _walk_scandir(path: str):
+    """
+    Yields the DirEntry of every file under path using os.scandir.
+
+    Like os.walk, files of a directory come before its subdirectories, symlinked
+    directories are not followed and unreadable directories are skipped. Hidden
+    directories, directories in DIRECTORIOS_IGNORADOS and macOS '._*' files are
+    pruned without being listed.
+
+    Directories are walked depth-first with an explicit stack of pending listings.
+    The directories that will be walked next are listed in a thread pool, at most
+    MAX_SCAN_WORKERS ahead of the walk, so their scandir I/O overlaps with the
+    caller's work while the yield order stays the same as a sequential walk and
+    only a bounded number of listings is held at once.
+    """
+    with ThreadPoolExecutor(max_workers=MAX_SCAN_WORKERS) as executor:
+        # Each slot is [directory, future of its listing, or None while not submitted]
+        stack = [[path, None]]
+        submitted = 0
+        while stack:
+            # Top up the read-ahead from the top of the stack, i.e. in walk order
+            i = len(stack) - 1
+            while i >= 0 and submitted < MAX_SCAN_WORKERS:
+                if stack[i][1] is None:
+                    stack[i][1] = executor.submit(_list_directory, stack[i][0])
+                    submitted += 1
+                i -= 1
+            _, listing = stack.pop()
+            submitted -= 1
+            files, subdirs = listing.result()
+            # Reversed so the first subdirectory is popped (and walked) first
+            stack.extend([subdir, None] for subdir in reversed(subdirs))
+            yield from files
+
 def find_files(search_path: str) -> List[Dict[str, Any]]:
     """
     Recursively finds and classifies SUNAT files in a given path,
     including searching within ZIP files and marking duplicates.
 
+    The directory walk runs on the calling thread while ZIPs on disk are
+    inspected in a thread pool; duplicates are marked afterwards in walk order.
+    A file is a duplicate when an earlier one has the same name and size.
+
     Args:
         search_path: The absolute path to the directory to search in.
 
     Returns:
         A list of dictionaries, where each dictionary represents a found
-        and classified SUNAT file with its status (UNICO/DUPLICADO).
+        and classified SUNAT file with its status (UNICO/DUPLICADO), the
+        physical file containing it ('base_path'), the member names
+        leading to it inside that file ('inner_paths', empty on disk) and
+        its uncompressed size in bytes ('size').
     """
-    found_files = []
-    seen_filenames = set()
     if not os.path.isdir(search_path):
         return []
 
-    for root, _, files in os.walk(search_path):
-        for file in files:
-            full_path = os.path.join(root, file)
-            
+    # Walk-ordered results: lists of files found on disk or futures of ZIP contents
+    pending = []
+    with ThreadPoolExecutor(max_workers=MAX_ZIP_WORKERS) as executor:
+        for entry in _walk_scandir(search_path):
+            file = entry.name
+            full_path = entry.path
+
             # Analyze file on disk
             file_details = _analyze_filename(file, full_path)
             if file_details:
-                if file in seen_filenames:
-                    file_details['status'] = 'DUPLICADO'
-                else:
-                    file_details['status'] = 'UNICO'
-                    seen_filenames.add(file)
-                found_files.append(file_details)
+                try:
+                    size = entry.stat().st_size
+                except OSError as e:
+                    # Removed or made unreadable since the directory was listed
+                    print(f"⚠️ Could not read file on disk: {full_path} ({e})")
+                    continue
+                file_details['base_path'] = full_path
+                file_details['inner_paths'] = []
+                file_details['size'] = size
+                pending.append([file_details])
 
             # If it's a ZIP, search inside it, unless the ZIP itself was already classified
             if file.lower().endswith(".zip") and not file_details:
-                try:
-                    with zipfile.ZipFile(full_path) as zip_file:
-                        _analyze_zip_recursively(zip_file, full_path, found_files, seen_filenames)
-                except zipfile.BadZipFile:
-                    print(f"⚠️ Invalid zip file on disk: {full_path}")
-                    continue
-    
+                pending.append(executor.submit(_process_zip_file, full_path))
+
+    found_files = []
+    # The keys reference the filename strings already held by found_files, so the set adds
+    # little memory on top of the results themselves
+    seen_files = set()
+    for result in pending:
+        files = result.result() if isinstance(result, Future) else result
+        for file_details in files:
+            file_key = (file_details['filename'], file_details['size'])
+            if file_key in seen_files:
+                file_details['status'] = 'DUPLICADO'
+            else:
+                file_details['status'] = 'UNICO'
+                seen_files.add(file_key)
+            found_files.append(file_details)
+
     return found_files
\ No newline at end of file
@@ -1,9 +1,25 @@
 import os
 import io
+import shutil
+import tempfile
 import zipfile
 from typing import List, Dict, Any
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 
+# Máximo de ZIPs contenedores en disco que se mantienen abiertos durante el empaquetado
+ZIP_CACHE_SIZE = 32
+
+# Formatos que ya vienen comprimidos: se guardan sin comprimir (ZIP_STORED) en el paquete
+EXTENSIONES_COMPRIMIDAS = frozenset({"pdf", "zip", "xlsx"})
+# Nivel DEFLATE para el resto (XML): el nivel 1 es mucho más rápido y comprime casi igual
+NIVEL_DEFLATE = 1
+# Tamaño de bloque al copiar archivos al paquete
+COPY_BUFFER_SIZE = 1 << 20
+# Tamaño hasta el que un archivo (de disco o extraído de un ZIP) se valida en memoria antes de pasar a disco
+SPOOL_MAX_SIZE = 64 << 20
+
 def _parse_zip_path(full_path: str):
     """Splits a path into the physical file path and nested paths within ZIPs."""
     # Normalize path separators for consistency
@@ -25,73 +41,250 @@ def _parse_zip_path(full_path: str):
     base_path = base_path.replace('/', os.sep)
     return base_path, inner_paths
 
-def _extract_from_zip(zip_path: any, inner_path_parts: List[str]):
-    """Recursively extracts a file's binary data from a zip or nested zips."""
+def _cache_zip(zip_cache: OrderedDict, key: tuple, zf: zipfile.ZipFile):
+    """Adds an open ZipFile to the cache, closing the least recently used one when it's full."""
+    zip_cache[key] = zf
+    if len(zip_cache) > ZIP_CACHE_SIZE:
+        _, evicted_zf = zip_cache.popitem(last=False)
+        evicted_zf.close()
+
+def _close_nested(nested_chain: List[tuple], depth: int):
+    """Closes the nested levels of nested_chain from depth down, along with their buffers."""
+    while len(nested_chain) > depth:
+        _, zf, buffer = nested_chain.pop()
+        zf.close()
+        buffer.close()
+
+def _get_cached_zip(zip_cache: OrderedDict, nested_chain: List[tuple], base_path: str, zip_parts: tuple) -> zipfile.ZipFile:
+    """
+    Returns an open ZipFile for a container (or a ZIP nested in it), reusing handles across files.
+
+    Containers on disk are kept in the zip_cache LRU. Nested levels are copied out
+    once (in memory up to SPOOL_MAX_SIZE, to a temporary file above it) because
+    later files read them at random offsets, which a ZipExtFile stream can only do
+    by decompressing again from the start. Only the chain of nested levels of the
+    last file is kept in nested_chain: files arrive grouped by container in walk
+    order, so the levels it shares with the next file are reused and the rest are
+    closed, which keeps a single chain of nested ZIPs open at a time.
+    """
+    key = (base_path,)
+    if key in zip_cache:
+        zf = zip_cache[key]
+        zip_cache.move_to_end(key)
+    else:
+        zf = zipfile.ZipFile(base_path, 'r')
+        _cache_zip(zip_cache, key, zf)
+    if not zip_parts:
+        return zf
+
+    depth = 0
+    while depth < min(len(nested_chain), len(zip_parts)) and nested_chain[depth][0] == key + zip_parts[:depth + 1]:
+        depth += 1
+    _close_nested(nested_chain, depth)
+    if depth:
+        zf = nested_chain[depth - 1][1]
+
+    for level in range(depth, len(zip_parts)):
+        member_info = zf.getinfo(zip_parts[level])
+        buffer = io.BytesIO() if member_info.file_size <= SPOOL_MAX_SIZE else tempfile.TemporaryFile()
+        try:
+            with zf.open(member_info) as member:
+                shutil.copyfileobj(member, buffer, COPY_BUFFER_SIZE)
+            buffer.seek(0)
+            zf = zipfile.ZipFile(buffer)
+        except Exception:
+            buffer.close()
+            raise
+        nested_chain.append((key + zip_parts[:level + 1], zf, buffer))
+    return zf
+
+def _set_compression(zinfo: zipfile.ZipInfo):
+    """Uses ZIP_STORED for already-compressed formats and fast DEFLATE otherwise."""
+    if zinfo.filename.rpartition('.')[2].lower() in EXTENSIONES_COMPRIMIDAS:
+        zinfo.compress_type = zipfile.ZIP_STORED
+    else:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        # Per-entry level read by ZipFile.writestr/open (exposed as compress_level since 3.13)
+        zinfo._compresslevel = NIVEL_DEFLATE
+
+def _copy_from_zip(zip_cache: OrderedDict, nested_chain: List[tuple], zip_path: str, inner_path_parts: List[str], final_zip: zipfile.ZipFile, filename: str):
+    """
+    Copies a file from a zip or nested zips into final_zip under filename.
+
+    The member is read to the end first (into a spooled temporary file, so only
+    large members touch the disk), which is when zipfile checks its CRC. Only a
+    member that read back intact gets an entry in final_zip; a corrupt one raises
+    before anything is written to the package.
+
+    The compression is chosen from the extension of filename, as for files on disk.
+    """
     try:
-        with zipfile.ZipFile(zip_path, 'r') as zf:
-            # If this is the last part of the path, read the file
-            if len(inner_path_parts) == 1:
-                return zf.read(inner_path_parts[0])
-            
-            # Otherwise, go one level deeper
-            nested_zip_data = zf.read(inner_path_parts[0])
-            nested_zip_file = io.BytesIO(nested_zip_data)
-            return _extract_from_zip(nested_zip_file, inner_path_parts[1:])
+        zf = _get_cached_zip(zip_cache, nested_chain, zip_path, tuple(inner_path_parts[:-1]))
+        src_info = zf.getinfo(inner_path_parts[-1])
     except zipfile.BadZipFile:
         print(f"Error: Invalid ZIP format for {zip_path}")
         raise
     except KeyError:
-        print(f"Error: Path not found inside ZIP: {inner_path_parts[0]}")
+        print(f"Error: Path not found inside ZIP: {':'.join(inner_path_parts)}")
         raise
 
-def create_zip_package(files_to_package: List[Dict[str, Any]], physical_files_to_delete: set, output_zip_path: str, log_filepath: str = None):
+    zinfo = zipfile.ZipInfo(filename, date_time=src_info.date_time)
+    _set_compression(zinfo)
+    # Lets zipfile decide up front whether the entry needs ZIP64
+    zinfo.file_size = src_info.file_size
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+        with zf.open(src_info) as src:
+            shutil.copyfileobj(src, spool, COPY_BUFFER_SIZE)
+        spool.seek(0)
+        with final_zip.open(zinfo, 'w') as dst:
+            shutil.copyfileobj(spool, dst, COPY_BUFFER_SIZE)
+
+def _copy_file_into(file_path: str, final_zip: zipfile.ZipFile, zinfo: zipfile.ZipInfo, copy_buf: bytearray):
     """
-    Creates a final ZIP package, logs the actions, and optionally deletes source files.
+    Copies a file on disk into final_zip as zinfo through copy_buf, a buffer reused for every file in the package.
 
-    Args:
-        files_to_package: A list of file dictionaries to be added to the zip.
-        physical_files_to_delete: A set of absolute paths to physical files to be deleted.
-        output_zip_path: The full path for the output ZIP file.
-        log_filepath: Optional path to a .txt file to log actions.
+    As in _copy_from_zip, the file is read to the end first (in memory, or into a
+    temporary file when it is larger than SPOOL_MAX_SIZE) and checked against the
+    size zinfo was built with. A file that can't be opened or read, or that
+    changed size meanwhile, raises before its entry is opened in final_zip.
     """
-    log_lines = []
+    view = memoryview(copy_buf)
+    spool = io.BytesIO() if zinfo.file_size <= SPOOL_MAX_SIZE else tempfile.TemporaryFile()
+    with spool:
+        # Unbuffered, so readinto fills copy_buf straight from the OS without per-chunk allocations
+        with open(file_path, 'rb', buffering=0) as src:
+            while True:
+                n = src.readinto(view)
+                if not n:
+                    break
+                spool.write(view[:n])
+        if spool.tell() != zinfo.file_size:
+            raise OSError(f"El archivo cambió de tamaño durante la lectura: {file_path}")
+        spool.seek(0)
+        with final_zip.open(zinfo, 'w') as dst:
+            while True:
+                n = spool.readinto(view)
+                if not n:
+                    break
+                dst.write(view[:n])
 
-    def log_action(message):
-        if log_filepath:
-            log_lines.append(message)
+def _unique_arcname(filename: str, used_names: set) -> str:
+    """Returns filename, or 'name (n).ext' when a different file already took that name in the package."""
+    if filename not in used_names:
+        return filename
+    stem, ext = os.path.splitext(filename)
+    n = 2
+    while f"{stem} ({n}){ext}" in used_names:
+        n += 1
+    return f"{stem} ({n}){ext}"
 
-    output_dir = os.path.dirname(output_zip_path)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        log_action(f"Directorio creado: {output_dir}")
+def _open_log(log_filepath: str, output_zip_path: str):
+    """Opens the process log with a 64 KB buffer and writes its header, or returns None."""
+    if not log_filepath:
+        return None
+    try:
+        log_f = open(log_filepath, 'w', encoding='utf-8', buffering=65536)
+        log_f.write("--- Log de Proceso ---\n")
+        log_f.write(f"Paquete ZIP de salida: {output_zip_path}\n")
+        log_f.write(f"Fecha: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        log_f.write("------------------------\n\n")
+        return log_f
+    except IOError as e:
+        print(f"\n[ERROR] No se pudo escribir el archivo de log: {e}")
+        return None
 
-    with zipfile.ZipFile(output_zip_path, 'w', zipfile.ZIP_DEFLATED) as final_zip:
-        for file_info in files_to_package:
-            full_path = file_info['path']
-            filename = file_info['filename']
-            
-            log_action(f"Procesando {filename}...")
+@contextmanager
+def _open_output_zip(output_zip_path: str, estimated_size: int = None):
+    """
+    Opens the output ZIP for writing, reserving estimated_size bytes up front when
+    the platform supports posix_fallocate so the file isn't extended on every write.
 
-            try:
-                base_path, inner_paths = _parse_zip_path(full_path)
+    The file is truncated to what was actually written when the block exits, so the
+    central directory written by ZipFile.close() stays at the end of the file.
+    """
+    fd = os.open(output_zip_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+    if estimated_size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, estimated_size)
+        except OSError:
+            # Not supported by this filesystem; the file just grows as it is written
+            pass
+    with os.fdopen(fd, 'wb', buffering=COPY_BUFFER_SIZE) as out_f:
+        try:
+            yield out_f
+        finally:
+            out_f.truncate()
+
+def _estimate_package_size(files_to_package: List[Dict[str, Any]]):
+    """
+    Returns a lower bound of the package size from the sizes reported by find_files,
+    or None when any is unknown (e.g. CSV rows).
+
+    Only entries written as ZIP_STORED count with their full size; what DEFLATE
+    leaves of the rest can't be told in advance, so they only count their local
+    and central directory headers. The bound never reserves space the package
+    won't use.
+    """
+    total = 0
+    for file_info in files_to_package:
+        size = file_info.get('size')
+        if size is None:
+            return None
+        name_len = len(file_info['filename'].encode('utf-8'))
+        total += zipfile.sizeFileHeader + zipfile.sizeCentralDir + 2 * name_len
+        if file_info['filename'].rpartition('.')[2].lower() in EXTENSIONES_COMPRIMIDAS:
+            total += size
+    return total
+
+def _write_package(files_to_package: List[Dict[str, Any]], physical_files_to_delete: set, output_zip_path: str, log_action):
+    """Builds the ZIP package and deletes the source files, reporting each step through log_action."""
+    # Containers stay open across files, so each central directory is parsed once
+    zip_cache = OrderedDict()
+    # Only the nested ZIPs leading to the current file stay open (see _get_cached_zip)
+    nested_chain = []
+    # Files with the same name but different content are all packaged, so names can collide
+    used_names = set()
+    copy_buf = bytearray(COPY_BUFFER_SIZE)
+    try:
+        with _open_output_zip(output_zip_path, _estimate_package_size(files_to_package)) as out_f, \
+                zipfile.ZipFile(out_f, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as final_zip:
+            for file_info in files_to_package:
+                full_path = file_info['path']
+                filename = file_info['filename']
 
-                if not inner_paths:
-                    if os.path.exists(base_path):
-                        with open(base_path, 'rb') as f:
-                            final_zip.writestr(filename, f.read())
-                        log_action(f"  -> [AGREGADO] {filename} al paquete.")
+                log_action(f"Procesando {filename}...")
+                arcname = _unique_arcname(filename, used_names)
+
+                try:
+                    # Files from find_files carry the parsed path; rows read from a CSV log don't
+                    if 'inner_paths' in file_info:
+                        base_path, inner_paths = file_info['base_path'], file_info['inner_paths']
                     else:
-                        log_action(f"  -> [ADVERTENCIA] No se encontró el archivo en disco: {base_path}")
-                else:
-                    if os.path.exists(base_path):
-                        file_data = _extract_from_zip(base_path, inner_paths)
-                        final_zip.writestr(filename, file_data)
-                        log_action(f"  -> [EXTRAÍDO Y AGREGADO] {filename} al paquete.")
+                        base_path, inner_paths = _parse_zip_path(full_path)
+
+                    if not inner_paths:
+                        if os.path.exists(base_path):
+                            zinfo = zipfile.ZipInfo.from_file(base_path, arcname, strict_timestamps=False)
+                            _set_compression(zinfo)
+                            _copy_file_into(base_path, final_zip, zinfo, copy_buf)
+                            used_names.add(arcname)
+                            log_action(f"  -> [AGREGADO] {arcname} al paquete.")
+                        else:
+                            log_action(f"  -> [ADVERTENCIA] No se encontró el archivo en disco: {base_path}")
                     else:
-                        log_action(f"  -> [ADVERTENCIA] No se encontró el ZIP contenedor en disco: {base_path}")
+                        if os.path.exists(base_path):
+                            _copy_from_zip(zip_cache, nested_chain, base_path, inner_paths, final_zip, arcname)
+                            used_names.add(arcname)
+                            log_action(f"  -> [EXTRAÍDO Y AGREGADO] {arcname} al paquete.")
+                        else:
+                            log_action(f"  -> [ADVERTENCIA] No se encontró el ZIP contenedor en disco: {base_path}")
 
-            except Exception as e:
-                log_action(f"  -> [ERROR] procesando {full_path}: {e}")
+                except Exception as e:
+                    log_action(f"  -> [ERROR] procesando {full_path}: {e}")
+    finally:
+        _close_nested(nested_chain, 0)
+        for zf in zip_cache.values():
+            zf.close()
 
     log_action(f"\nPaquete ZIP creado con éxito en: {output_zip_path}")
 
@@ -103,16 +296,43 @@ def create_zip_package(files_to_package: List[Dict[str, Any]], physical_files_to
                 log_action(f"  -> [ELIMINADO] {file_path}")
             except OSError as e:
                 log_action(f"  -> [ERROR] al eliminar {file_path}: {e}")
-    
-    # Write the collected log lines to the file
-    if log_filepath:
-        try:
-            with open(log_filepath, 'w', encoding='utf-8') as log_f:
-                log_f.write("--- Log de Proceso ---\n")
-                log_f.write(f"Paquete ZIP de salida: {output_zip_path}\n")
-                log_f.write(f"Fecha: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                log_f.write("------------------------\n\n")
-                log_f.write("\n".join(log_lines))
-            print(f"\nLog del proceso guardado en: {log_filepath}")
-        except IOError as e:
-            print(f"\n[ERROR] No se pudo escribir el archivo de log: {e}")
\ No newline at end of file
+
+def create_zip_package(files_to_package: List[Dict[str, Any]], physical_files_to_delete: set, output_zip_path: str, log_filepath: str = None):
+    """
+    Creates a final ZIP package, logs the actions, and optionally deletes source files.
+
+    Args:
+        files_to_package: A list of file dictionaries to be added to the zip.
+        physical_files_to_delete: A set of absolute paths to physical files to be deleted.
+        output_zip_path: The full path for the output ZIP file.
+        log_filepath: Optional path to a .txt file to log actions.
+    """
+    # The log may be written inside the output directory, so create it first
+    output_dir = os.path.dirname(output_zip_path)
+    created_dir = bool(output_dir) and not os.path.exists(output_dir)
+    if created_dir:
+        os.makedirs(output_dir)
+
+    log_f = _open_log(log_filepath, output_zip_path)
+
+    def log_action(message):
+        nonlocal log_f
+        if log_f:
+            try:
+                log_f.write(message + "\n")
+            except IOError as e:
+                print(f"\n[ERROR] No se pudo escribir el archivo de log: {e}")
+                log_f.close()
+                log_f = None
+
+    if created_dir:
+        log_action(f"Directorio creado: {output_dir}")
+
+    try:
+        _write_package(files_to_package, physical_files_to_delete, output_zip_path, log_action)
+    finally:
+        if log_f:
+            log_f.close()
+    # Only reached when the package was written
+    if log_f:
+        print(f"\nLog del proceso guardado en: {log_filepath}")
\ No newline at end of file